@@ -12,11 +12,17 @@ Architecture:
 import asyncio
 import logging
 import os
-from collections import defaultdict
-from datetime import datetime
-
+import re
+import time
+from collections import OrderedDict, deque
+from datetime import date, datetime
+from itertools import islice
+from typing import Optional
+
+import httpx
+import numpy as np
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -36,10 +42,18 @@ OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY", "")
 ROUTER_MODEL = os.environ.get("ROUTER_MODEL", "anthropic/claude-haiku-4.5")
 SPECIALIST_MODEL = os.environ.get("SPECIALIST_MODEL", "anthropic/claude-sonnet-4")
 MANAGER_CHAT_ID = os.environ.get("MANAGER_CHAT_ID", "")
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "openai/text-embedding-3-small")
 
-ai_client = OpenAI(
+# One pooled HTTP/2 client for all LLM calls — keeps TLS connections warm
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+)
+ai_client = AsyncOpenAI(
     base_url="https://openrouter.ai/api/v1",
     api_key=OPENROUTER_API_KEY,
+    http_client=http_client,
 )
 
 logging.basicConfig(
@@ -49,25 +63,118 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ── Conversation Memory ──────────────────────────────────────────────
-conversations: dict[int, list[dict]] = defaultdict(list)
 MAX_HISTORY = 10
+HISTORY_TOKEN_BUDGET = 1500  # Prompt history is cut by tokens, newest first
+MAX_CHATS = 10_000  # LRU cap on per-chat state
+CHAT_IDLE_TTL = 24 * 3600  # Drop chats idle for 24h
+EVICT_INTERVAL = 300  # Idle scan every 5 min
+
+
+class LRUDict(OrderedDict):
+    """defaultdict-like OrderedDict capped at max_size, least recently used first.
+
+    Every read/write moves the key to the end, so iteration order is also
+    last-activity order — idle eviction just pops from the front.
+    """
+
+    def __init__(self, default_factory, max_size: int):
+        super().__init__()
+        self.default_factory = default_factory
+        self.max_size = max_size
+        self.last_activity: dict = {}
+
+    def __missing__(self, key):
+        if self.default_factory is None:
+            raise KeyError(key)
+        value = self[key] = self.default_factory()
+        return value
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self._touch(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._touch(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.last_activity.pop(key, None)
+
+    def pop(self, key, *default):
+        self.last_activity.pop(key, None)
+        return super().pop(key, *default)
+
+    def popitem(self, last: bool = True):
+        key, value = super().popitem(last)
+        self.last_activity.pop(key, None)
+        return key, value
+
+    def _touch(self, key):
+        self.move_to_end(key)
+        self.last_activity[key] = time.monotonic()
+
+    def evict_idle(self, max_idle: float) -> int:
+        """Drop entries untouched for max_idle seconds; returns how many."""
+        deadline = time.monotonic() - max_idle
+        evicted = 0
+        while self and self.last_activity[next(iter(self))] < deadline:
+            self.popitem(last=False)
+            evicted += 1
+        return evicted
+
+
+# Turns are stored as compact (role_id, content, tokens, manager_line) tuples;
+# deque(maxlen) drops the oldest turn on append — no list copies
+ROLE_USER, ROLE_ASSISTANT = 0, 1
+ROLE_NAMES = ("user", "assistant")
+ROLE_ICONS = ("👤", "🤖")
+conversations: dict[int, deque[tuple[int, str, int, str]]] = LRUDict(lambda: deque(maxlen=MAX_HISTORY), MAX_CHATS)
 
 # ── Message Batching (debounce) ─────────────────────────────────────
 # Collect multiple rapid messages into one before processing
 DEBOUNCE_SECONDS = 3.0  # Wait 3s after last message
-message_buffers: dict[int, list[str]] = defaultdict(list)
-debounce_tasks: dict[int, asyncio.Task] = {}
-debounce_contexts: dict[int, tuple] = {}  # (update, context) for delayed processing
+MAX_COMBINED_CHARS = 2000  # Cap on batched text sent to the LLM
+message_buffers: dict[int, list[str]] = LRUDict(list, MAX_CHATS)
+# One worker per chat burst; setting its event restarts the debounce window
+debounce_events: dict[int, asyncio.Event] = {}
+debounce_contexts: dict[int, tuple] = {}  # (user, context) of the latest message in the burst
+
+# ── Speculative Specialist ──────────────────────────────────────────
+# Specialist is started on last turn's category in parallel with the router
+last_categories: dict[int, str] = LRUDict(None, MAX_CHATS)
+background_tasks: set[asyncio.Task] = set()
+
+
+CHARS_PER_TOKEN = 2.5  # Russian/Kazakh (Cyrillic) tokenizes at ~2-3 chars per token
+
+
+def estimate_tokens(text: str) -> int:
+    # Close enough for budgeting, no tokenizer dependency
+    return int(len(text) / CHARS_PER_TOKEN) + 1
 
 
 def get_history(chat_id: int) -> list[dict]:
-    return conversations[chat_id][-MAX_HISTORY:]
+    """Most recent turns within HISTORY_TOKEN_BUDGET, in API message format."""
+    turns = []
+    budget = HISTORY_TOKEN_BUDGET
+    for role, content, tokens, _ in reversed(conversations[chat_id]):
+        budget -= tokens
+        if budget < 0:
+            break
+        turns.append((role, content))
+    # History must start with a user turn
+    while turns and turns[-1][0] != ROLE_USER:
+        turns.pop()
+    return [{"role": ROLE_NAMES[role], "content": content} for role, content in reversed(turns)]
 
 
-def add_message(chat_id: int, role: str, content: str):
-    conversations[chat_id].append({"role": role, "content": content})
-    if len(conversations[chat_id]) > MAX_HISTORY * 2:
-        conversations[chat_id] = conversations[chat_id][-MAX_HISTORY:]
+def add_message(chat_id: int, role: int, content: str):
+    manager_line = f"{ROLE_ICONS[role]} {content[:150]}"
+    conversations[chat_id].append((role, content, estimate_tokens(content), manager_line))
 
 
 # ── AGENT 1: Router (fast, cheap) ────────────────────────────────────
@@ -82,9 +189,63 @@ ROUTER_PROMPT = f"""Ты классификатор сообщений для д
 
 Верни ОДНО слово: general, entrance, attractions, birthday, booking, menu, drinks, ramadan, vacancy, complaint, other"""
 
+# Static prompts are sent as content blocks with cache_control —
+# OpenRouter passes it through to Anthropic's prompt caching
+CACHE_CONTROL = {"type": "ephemeral"}
+ROUTER_SYSTEM = [{"type": "text", "text": ROUTER_PROMPT, "cache_control": CACHE_CONTROL}]
+
+# ── Router fast path (keywords, no LLM) ──────────────────────────────
+# Hand-picked whole words/phrases only — prefixes misfire ("тир" → "тирамису")
+KEYWORDS = {
+    "general": ["привет", "здравствуйте", "здравствуй", "сәлем", "сәлеметсіз бе", "адрес", "где вы",
+                "где находитесь", "график"],
+    "entrance": ["вход", "входа", "входной билет", "econom", "standart", "premium", "многодетным", "многодетных"],
+    "attractions": ["аттракцион", "аттракционы", "картинг", "vr", "аквагрим", "тир", "живой уголок",
+                    "аниматор", "аниматоры", "стрельба из лука"],
+    "birthday": ["др", "день рождения", "дня рождения", "день рождение", "start party", "happy party",
+                 "dream party"],
+    "booking": ["забронировать", "бронь", "бронирование", "бронировать", "депозит", "предоплата", "тапчан",
+                "тапчаны"],
+    "menu": ["меню", "еда", "блюда", "блюдо", "банкетное меню"],
+    "drinks": ["напитки", "напиток", "лимонад", "лимонады", "морс", "чай", "мороженое"],
+    "ramadan": ["рамадан", "ауызашар", "ифтар"],
+    "vacancy": ["вакансия", "вакансии", "трудоустройство"],
+    "complaint": ["жалоба", "жалобу"],
+    "other": ["менеджер", "менеджера", "менеджером", "оператор", "живой человек"],
+}
+
+KEYWORD_PATTERNS = {
+    category: re.compile(
+        r"\b(?:" + "|".join(r"\s+".join(map(re.escape, word.split())) for word in words) + r")\b",
+        re.IGNORECASE,
+    )
+    for category, words in KEYWORDS.items()
+}
+
+
+def route_by_keywords(user_message: str) -> Optional[str]:
+    """Return category if exactly one matches confidently, else None (ask the LLM)."""
+    hits = {}
+    for category, pattern in KEYWORD_PATTERNS.items():
+        count = len(pattern.findall(user_message))
+        if count:
+            hits[category] = count
+    if len(hits) != 1:
+        return None
+    category, count = hits.popitem()
+    if count >= 2 or len(user_message) < 15:
+        return category
+    return None
+
 
 async def route_message(chat_id: int, user_message: str) -> str:
     """Classify message into a category using fast/cheap model."""
+    # Fast path only where it can't contradict "keep the topic" — new dialog or same topic
+    category = route_by_keywords(user_message)
+    if category and (not conversations[chat_id] or category == last_categories.get(chat_id)):
+        logger.info(f"Router (keywords): '{user_message[:50]}' → {category}")
+        return category
+
     history = get_history(chat_id)
 
     # Build context summary from recent messages
@@ -95,10 +256,10 @@ async def route_message(chat_id: int, user_message: str) -> str:
     context = "\n".join(context_lines) if context_lines else "Новый диалог"
 
     try:
-        response = ai_client.chat.completions.create(
+        response = await ai_client.chat.completions.create(
             model=ROUTER_MODEL,
             messages=[
-                {"role": "system", "content": ROUTER_PROMPT},
+                {"role": "system", "content": ROUTER_SYSTEM},
                 {"role": "user", "content": f"Контекст диалога:\n{context}\n\nНовое сообщение клиента: {user_message}"},
             ],
             temperature=0,
@@ -117,9 +278,8 @@ async def route_message(chat_id: int, user_message: str) -> str:
 
 
 # ── AGENT 2: Specialist (smart, focused) ─────────────────────────────
-SPECIALIST_PROMPT_TEMPLATE = """Ты — дружелюбный консультант детского центра Kids Park в Караганде.
-
-СЕГОДНЯ: {today_date} ({today_weekday})
+# Prompt is split for prefix caching: static rules → per-category KB → date tail
+SPECIALIST_RULES = """Ты — дружелюбный консультант детского центра Kids Park в Караганде.
 
 СТИЛЬ ОБЩЕНИЯ:
 - Отвечай на языке клиента (русский → русский, казахский → казахский)
@@ -137,60 +297,298 @@ SPECIALIST_PROMPT_TEMPLATE = """Ты — дружелюбный консульт
 - Если клиент просит связать с менеджером или живым человеком — добавь [MANAGER]
 - Если клиент жалуется серьёзно — добавь [MANAGER]
 - Если не знаешь ответа — добавь [MANAGER]
-- НЕ добавляй [MANAGER] просто при вопросах о ценах, меню, графике и т.д.
+- НЕ добавляй [MANAGER] просто при вопросах о ценах, меню, графике и т.д."""
+
+# Rules + KB blocks are stable per category → cached; only the date tail changes
+CATEGORY_SYSTEM_BLOCKS: dict[str, list[dict]] = {
+    cat: [
+        {"type": "text", "text": SPECIALIST_RULES, "cache_control": CACHE_CONTROL},
+        {"type": "text", "text": f"БАЗА ЗНАНИЙ:\n{kb}", "cache_control": CACHE_CONTROL},
+    ]
+    for cat, kb in CATEGORY_KB.items()
+}
 
-БАЗА ЗНАНИЙ:
-{kb_section}"""
+MANAGER_TAG = "[MANAGER]"
+SPECIALIST_ERROR_TEXT = "Извините, произошла небольшая ошибка. Попробуйте ещё раз через минуту! 🙏"
 
 WEEKDAYS_RU = {
     0: "понедельник", 1: "вторник", 2: "среда", 3: "четверг",
     4: "пятница", 5: "суббота", 6: "воскресенье",
 }
 
+# (date, "dd.mm.yyyy", weekday) — recomputed once a day, keeps the date tail stable
+_today_cache: Optional[tuple[date, str, str]] = None
 
-async def specialist_respond(chat_id: int, user_message: str, category: str) -> dict:
-    """Generate response using specialist with relevant KB section."""
-    kb_section = CATEGORY_KB.get(category, CATEGORY_KB["other"])
-    now = datetime.now()
-    system_prompt = SPECIALIST_PROMPT_TEMPLATE.format(
-        kb_section=kb_section,
-        today_date=now.strftime("%d.%m.%Y"),
-        today_weekday=WEEKDAYS_RU[now.weekday()],
-    )
 
-    history = get_history(chat_id)
-    messages = [{"role": "system", "content": system_prompt}]
-    messages.extend(history)
-    messages.append({"role": "user", "content": user_message})
+def _get_today() -> tuple[date, str, str]:
+    global _today_cache
+    today = date.today()
+    if _today_cache is None or _today_cache[0] != today:
+        _today_cache = (today, today.strftime("%d.%m.%Y"), WEEKDAYS_RU[today.weekday()])
+    return _today_cache
+
+
+# Full system blocks per category for today — the same objects are reused all day
+SPECIALIST_SYSTEMS: dict[str, list[dict]] = {}
+_specialist_systems_date: Optional[date] = None
+
 
+def get_specialist_system(category: str) -> list[dict]:
+    global _specialist_systems_date
+    today, today_date, today_weekday = _get_today()
+    if _specialist_systems_date != today:
+        date_block = {"type": "text", "text": f"СЕГОДНЯ: {today_date} ({today_weekday})"}
+        for cat, blocks in CATEGORY_SYSTEM_BLOCKS.items():
+            SPECIALIST_SYSTEMS[cat] = blocks + [date_block]
+        _specialist_systems_date = today
+    return SPECIALIST_SYSTEMS.get(category, SPECIALIST_SYSTEMS["other"])
+
+
+# First sentence boundary — punctuation before a capitalized next sentence, or a
+# paragraph break. A period after a known abbreviation ("г. Караганда",
+# "ул. Строителей") is not a sentence end.
+ABBREVIATIONS = ("г", "ул", "д", "пр", "мкр", "им", "т.е", "т.к", "т.д", "т.п")
+SENTENCE_END = re.compile(
+    "(?:" + "".join(rf"(?<!\b{re.escape(abbr)})" for abbr in ABBREVIATIONS) + r"\.|[!?…])\s+(?=[A-ZА-ЯЁ])|\n\n"
+)
+MIN_EARLY_CHARS = 40  # Don't send a tiny fragment as its own message
+TYPING_INTERVAL = 4.0  # Telegram shows "typing" for ~5s
+
+
+async def keep_typing(bot_context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """Refresh the typing indicator until cancelled."""
+    try:
+        while True:
+            await bot_context.bot.send_chat_action(chat_id, "typing")
+            await asyncio.sleep(TYPING_INTERVAL)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"Typing indicator failed: {e}")
+
+
+async def stream_specialist(
+    chat_id: int,
+    messages: list[dict],
+    bot_context: ContextTypes.DEFAULT_TYPE,
+    send_after: Optional[asyncio.Event] = None,
+) -> tuple[str, str, bool]:
+    """Stream the completion, sending the first sentence as soon as it's ready.
+
+    Returns (raw_text, sent_prefix, partial); partial means the stream broke
+    after the first sentence went out and raw_text is truncated. With send_after
+    the early send waits for that event (speculative call confirmed by the
+    router); an unconfirmed call is cancelled before it sends anything. [MANAGER] is only handled by the caller
+    once the stream completes; a first sentence containing "[" is never sent early.
+    The typing indicator is kept alive by the caller (process_batched_messages).
+    """
+    parts = []
+    sent = ""
+    partial = False
+    first_pending = True
     try:
-        response = ai_client.chat.completions.create(
+        stream = await ai_client.chat.completions.create(
             model=SPECIALIST_MODEL,
             messages=messages,
             temperature=0.7,
             max_tokens=500,  # Короткие ответы!
+            stream=True,
         )
-        raw = response.choices[0].message.content.strip()
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            parts.append(delta)
+
+            if first_pending:
+                text = "".join(parts)
+                match = SENTENCE_END.search(text, MIN_EARLY_CHARS)
+                if match:
+                    first_pending = False
+                    prefix = text[:match.end()].strip()
+                    if prefix and "[" not in prefix:
+                        if send_after is not None:
+                            await send_after.wait()
+                        try:
+                            await bot_context.bot.send_message(chat_id, prefix)
+                            sent = prefix
+                        except Exception as e:
+                            # Not fatal — the full answer is sent once the stream ends
+                            logger.warning(f"[{chat_id}] Early send failed: {e}")
+    except Exception as e:
+        if not sent:
+            raise
+        # The user already has the first sentence — keep what arrived instead of an error
+        logger.error(f"[{chat_id}] Specialist stream broke after first sentence: {e}")
+        partial = True
+
+    return "".join(parts).strip(), sent, partial
+
+
+async def specialist_respond(
+    chat_id: int,
+    user_message: str,
+    category: str,
+    bot_context: Optional[ContextTypes.DEFAULT_TYPE] = None,
+    send_after: Optional[asyncio.Event] = None,
+) -> dict:
+    """Generate response using specialist with relevant KB section.
+
+    With bot_context the reply is streamed and its first sentence sent right
+    away (or once send_after is set); result["sent"] holds the part already delivered to the chat and
+    result["partial"] is set if the stream broke midway (truncated answer).
+    """
+    system_blocks = get_specialist_system(category)
 
-        # Check for manager escalation tag
-        needs_manager = "[MANAGER]" in raw
-        clean_response = raw.replace("[MANAGER]", "").strip()
+    history = get_history(chat_id)
+    messages = [{"role": "system", "content": system_blocks}]
+    messages.extend(history)
+    messages.append({"role": "user", "content": user_message})
+
+    try:
+        if bot_context is not None:
+            raw, sent, partial = await stream_specialist(chat_id, messages, bot_context, send_after)
+        else:
+            response = await ai_client.chat.completions.create(
+                model=SPECIALIST_MODEL,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=500,  # Короткие ответы!
+            )
+            raw = response.choices[0].message.content.strip()
+            sent = ""
+            partial = False
+
+        # Check for manager escalation tag — single scan
+        before, tag, after = raw.partition(MANAGER_TAG)
+        needs_manager = bool(tag)
+        clean_response = (before + after.replace(MANAGER_TAG, "")).strip() if tag else raw
 
         return {
             "response": clean_response,
             "needs_manager": needs_manager,
             "category": category,
+            "sent": sent,
+            "partial": partial,
         }
     except Exception as e:
         logger.error(f"Specialist error: {e}")
         return {
-            "response": "Извините, произошла небольшая ошибка. Попробуйте ещё раз через минуту! 🙏",
+            "response": SPECIALIST_ERROR_TEXT,
             "needs_manager": False,
             "category": category,
         }
 
 
+# ── Semantic Cache (FAQ) ─────────────────────────────────────────────
+# New-session FAQ questions ("сколько стоит вход?") reuse an earlier answer
+# by embedding similarity — skips both router and specialist
+SEMANTIC_THRESHOLD = 0.92
+SEMANTIC_TTL = 3600  # 1h
+SEMANTIC_MAX_ENTRIES = 500
+SEMANTIC_LOOKUP_TIMEOUT = 1.0  # Slow embeddings count as a miss, never hold up the reply
+
+
+class SemanticCache:
+    """(embedding, category, response) store; lookup is a single matmul.
+
+    Entries only live for the day they were created — answers may depend on
+    today's date (weekday vs weekend prices). Similarity can't tell "вход для
+    ребёнка 3 лет" from "…10 лет", so only generic questions (see
+    is_generic_question) are stored or looked up; details spelled out in words
+    ("три года") can still slip through.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.vectors: Optional[np.ndarray] = None  # (N, dim), L2-normalized rows
+        self.categories: list[str] = []
+        self.responses: list[str] = []
+        self.created: list[float] = []
+        self.days: list[date] = []
+        self.last_used: list[float] = []
+
+    def _keep(self, keep: list[int]):
+        self.vectors = self.vectors[keep] if keep else None
+        self.categories = [self.categories[i] for i in keep]
+        self.responses = [self.responses[i] for i in keep]
+        self.created = [self.created[i] for i in keep]
+        self.days = [self.days[i] for i in keep]
+        self.last_used = [self.last_used[i] for i in keep]
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        today = _get_today()[0]
+        if self.created and (self.created[0] < deadline or self.days[0] != today):
+            self._keep([
+                i for i, (ts, day) in enumerate(zip(self.created, self.days))
+                if ts >= deadline and day == today
+            ])
+
+    def lookup(self, query: np.ndarray) -> Optional[tuple[str, str]]:
+        """Return (category, response) of the closest entry above threshold."""
+        self._expire()
+        if self.vectors is None:
+            return None
+        scores = self.vectors @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        self.last_used[best] = time.monotonic()
+        return self.categories[best], self.responses[best]
+
+    def add(self, query: np.ndarray, category: str, response: str):
+        self._expire()
+        if len(self.responses) >= self.max_entries:
+            lru = int(np.argmin(self.last_used))
+            self._keep([i for i in range(len(self.responses)) if i != lru])
+        row = query[np.newaxis, :]
+        self.vectors = row if self.vectors is None else np.vstack([self.vectors, row])
+        now = time.monotonic()
+        self.categories.append(category)
+        self.responses.append(response)
+        self.created.append(now)
+        self.days.append(_get_today()[0])
+        self.last_used.append(now)
+
+    def invalidate(self, category: Optional[str] = None):
+        """Drop entries for a category (or everything) — call when KB changes."""
+        if category is None:
+            self._keep([])
+        else:
+            self._keep([i for i, c in enumerate(self.categories) if c != category])
+
+
+semantic_cache = SemanticCache(SEMANTIC_MAX_ENTRIES, SEMANTIC_TTL, SEMANTIC_THRESHOLD)
+
+# Digits (ages, dates, counts) or a capitalized word after the first (a name)
+PERSONAL_DETAILS = re.compile(r"\d|(?<=\s)[A-ZА-ЯЁ]")
+
+
+def is_generic_question(text: str) -> bool:
+    """True if the question carries no personal details, so its answer can be shared."""
+    return not PERSONAL_DETAILS.search(text)
+
+
+async def embed_text(text: str) -> Optional[np.ndarray]:
+    """Embed text with a cheap model; None on failure (cache is just skipped)."""
+    try:
+        response = await ai_client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+    except Exception as e:
+        logger.error(f"Embedding error: {e}")
+        return None
+
+
 # ── Notify Manager ───────────────────────────────────────────────────
+MANAGER_RECENT_TURNS = 6
+# chat_id → (last turn at render time, rendered text); reused until a new turn arrives
+last_rendered_history: dict[int, tuple[tuple, str]] = LRUDict(None, MAX_CHATS)
+
+
 async def notify_manager(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user, category: str):
     if not MANAGER_CHAT_ID:
         logger.warning("MANAGER_CHAT_ID not set")
@@ -199,12 +597,16 @@ async def notify_manager(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user,
     username = f"@{user.username}" if user.username else f"{user.first_name} {user.last_name or ''}".strip()
     now = datetime.now().strftime("%d.%m.%Y %H:%M")
 
-    # Last few messages for context
-    history = get_history(chat_id)
-    recent = "\n".join(
-        f"{'👤' if m['role'] == 'user' else '🤖'} {m['content'][:150]}"
-        for m in history[-6:]
-    )
+    # Last few messages for context — lines are pre-rendered in add_message
+    turns = conversations[chat_id]
+    last_turn = turns[-1] if turns else None
+    cached = last_rendered_history.get(chat_id)
+    if cached and cached[0] is last_turn:
+        recent = cached[1]
+    else:
+        start = max(0, len(turns) - MANAGER_RECENT_TURNS)
+        recent = "\n".join(turn[3] for turn in islice(turns, start, None))
+        last_rendered_history[chat_id] = (last_turn, recent)
 
     text = (
         f"🔔 Нужен менеджер!\n\n"
@@ -223,7 +625,9 @@ async def notify_manager(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user,
 # ── Bot Handlers ─────────────────────────────────────────────────────
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    conversations[chat_id] = []
+    conversations.pop(chat_id, None)
+    last_categories.pop(chat_id, None)
+    last_rendered_history.pop(chat_id, None)
     logger.info(f"/start from {chat_id}")
 
     await update.message.reply_text(
@@ -261,41 +665,117 @@ async def cmd_register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Ваш Chat ID: `{chat_id}`", parse_mode="Markdown")
 
 
+async def answer_message(chat_id: int, combined_text: str, bot_context: ContextTypes.DEFAULT_TYPE) -> dict:
+    """Route the batched text and produce the specialist's (or cached) answer."""
+    # Step 1: ROUTER — classify message (fast, cheap),
+    # speculatively running SPECIALIST on last turn's category in parallel
+    router_task = asyncio.create_task(route_message(chat_id, combined_text))
+    # The speculative answer streams too, but its first sentence is held until
+    # the router confirms the guess
+    predicted = last_categories.get(chat_id)
+    route_confirmed = asyncio.Event()
+    speculative_task = None
+    if predicted:
+        speculative_task = asyncio.create_task(
+            specialist_respond(chat_id, combined_text, predicted, bot_context, route_confirmed)
+        )
+
+    # Semantic cache — only for generic questions opening a new session,
+    # answers there don't depend on context or the customer's details
+    query_vector = None
+    cached = None
+    if not conversations[chat_id] and is_generic_question(combined_text):
+        try:
+            query_vector = await asyncio.wait_for(embed_text(combined_text), SEMANTIC_LOOKUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"[{chat_id}] Embedding timed out, skipping semantic cache")
+        if query_vector is not None:
+            cached = semantic_cache.lookup(query_vector)
+
+    if cached:
+        router_task.cancel()
+        if speculative_task:
+            speculative_task.cancel()
+        category, response = cached
+        result = {"response": response, "needs_manager": False, "category": category}
+        logger.info(f"[{chat_id}] Semantic cache hit ({category})")
+    else:
+        category = await router_task
+
+        # Step 2: SPECIALIST — generate response (smart, focused KB)
+        if speculative_task and predicted == category:
+            route_confirmed.set()
+            result = await speculative_task
+        else:
+            if speculative_task:
+                # Wrong guess — its answer can't be reused, don't pay for the rest of it
+                speculative_task.cancel()
+                logger.info(f"[{chat_id}] Speculation miss: {predicted} → {category}")
+            result = await specialist_respond(chat_id, combined_text, category, bot_context)
+
+        # Context-free answer to a new session — reusable unless it escalated or was cut off
+        if (
+            query_vector is not None
+            and not result["needs_manager"]
+            and not result.get("partial")
+            and result["response"] != SPECIALIST_ERROR_TEXT
+        ):
+            semantic_cache.add(query_vector, category, result["response"])
+    last_categories[chat_id] = category
+    return result
+
+
 async def process_batched_messages(chat_id: int, user, bot_context: ContextTypes.DEFAULT_TYPE):
     """Process all collected messages after debounce timer expires."""
-    await asyncio.sleep(DEBOUNCE_SECONDS)
-
     # Grab all buffered messages and clear
     messages = message_buffers.pop(chat_id, [])
-    debounce_tasks.pop(chat_id, None)
-    debounce_contexts.pop(chat_id, None)
 
     if not messages:
         return
 
-    # Combine multiple messages into one
-    combined_text = " ".join(messages)
+    # Drop adjacent duplicates (client retries, repeated question), then combine
+    messages = [m for i, m in enumerate(messages) if i == 0 or m != messages[i - 1]]
+    combined_text = " ".join(messages)[:MAX_COMBINED_CHARS]
     logger.info(f"[{chat_id}] Batched {len(messages)} msg(s): '{combined_text[:80]}'")
 
-    await bot_context.bot.send_chat_action(chat_id, "typing")
-
-    # Step 1: ROUTER — classify message (fast, cheap)
-    category = await route_message(chat_id, combined_text)
-
-    # Step 2: SPECIALIST — generate response (smart, focused KB)
-    result = await specialist_respond(chat_id, combined_text, category)
+    # One typing loop for the whole turn — stopped right before the reply is sent
+    typing_task = asyncio.create_task(keep_typing(bot_context, chat_id))
+    try:
+        result = await answer_message(chat_id, combined_text, bot_context)
+    finally:
+        typing_task.cancel()
+    category = result["category"]
 
     # Step 3: Save history
-    add_message(chat_id, "user", combined_text)
-    add_message(chat_id, "assistant", result["response"])
-
-    # Step 4: Send response
-    await bot_context.bot.send_message(chat_id, result["response"])
-
-    # Step 5: Escalate if needed
+    add_message(chat_id, ROLE_USER, combined_text)
+    add_message(chat_id, ROLE_ASSISTANT, result["response"])
+
+    # Step 4: Send response (minus the first sentence if it was already streamed)
+    # and escalate if needed — independent Telegram calls, run concurrently
+    sends = []
+    sent = result.get("sent", "")
+    remainder = result["response"][len(sent):].strip() if sent else result["response"]
+    if remainder:
+        sends.append(bot_context.bot.send_message(chat_id, remainder))
     if result["needs_manager"]:
-        await notify_manager(bot_context, chat_id, user, category)
+        sends.append(notify_manager(bot_context, chat_id, user, category))
         logger.info(f"[{chat_id}] Escalated to manager ({category})")
+    await asyncio.gather(*sends)
+
+
+async def debounce_worker(chat_id: int):
+    """Wait until DEBOUNCE_SECONDS pass without a new message, then flush the buffer."""
+    event = debounce_events[chat_id]
+    while True:
+        event.clear()
+        try:
+            await asyncio.wait_for(event.wait(), timeout=DEBOUNCE_SECONDS)
+        except asyncio.TimeoutError:
+            break
+    # No await between here and the buffer pop — later messages start a new worker
+    debounce_events.pop(chat_id, None)
+    user, bot_context = debounce_contexts.pop(chat_id)
+    await process_batched_messages(chat_id, user, bot_context)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -313,14 +793,41 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Add message to buffer
     message_buffers[chat_id].append(user_text)
 
-    # Cancel previous debounce timer if exists
-    if chat_id in debounce_tasks:
-        debounce_tasks[chat_id].cancel()
+    # Latest sender wins — in group chats that's who the manager should see
+    debounce_contexts[chat_id] = (user, context)
 
-    # Start new debounce timer
-    debounce_tasks[chat_id] = asyncio.create_task(
-        process_batched_messages(chat_id, user, context)
-    )
+    # Extend the running debounce timer, or start a worker for a new burst
+    event = debounce_events.get(chat_id)
+    if event:
+        event.set()
+        return
+
+    debounce_events[chat_id] = asyncio.Event()
+    task = asyncio.create_task(debounce_worker(chat_id))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def evict_idle_chats():
+    """Background loop: forget chats that have been idle for CHAT_IDLE_TTL."""
+    while True:
+        await asyncio.sleep(EVICT_INTERVAL)
+        evicted = conversations.evict_idle(CHAT_IDLE_TTL)
+        message_buffers.evict_idle(CHAT_IDLE_TTL)
+        last_categories.evict_idle(CHAT_IDLE_TTL)
+        last_rendered_history.evict_idle(CHAT_IDLE_TTL)
+        if evicted:
+            logger.info(f"Evicted {evicted} idle chat(s), {len(conversations)} active")
+
+
+async def post_init(app: Application):
+    task = asyncio.create_task(evict_idle_chats())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def post_shutdown(app: Application):
+    await http_client.aclose()
 
 
 # ── Main ─────────────────────────────────────────────────────────────
@@ -330,7 +837,7 @@ def main():
     if not OPENROUTER_API_KEY or OPENROUTER_API_KEY == "YOUR_KEY_HERE":
         logger.warning("OPENROUTER_API_KEY not set!")
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
     app.add_handler(CommandHandler("manager", cmd_manager))